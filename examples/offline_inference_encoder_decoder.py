@@ -10,9 +10,14 @@ from vllm.inputs import (ExplicitEncoderDecoderPrompt, TextPrompt,
 dtype = "float"
 
 # Create a BART encoder/decoder model instance
+#
+# CUDA graphs are captured for the decode phase unless eager mode is
+# enforced; this removes most of the per-token kernel launch overhead.
+# Pass enforce_eager=True to skip graph capture, e.g. when debugging.
 llm = LLM(
     model="facebook/bart-large-cnn",
     dtype=dtype,
+    enforce_eager=False,
 )
 
 # Get BART tokenizer
@@ -62,17 +67,18 @@ enc_dec_prompt3 = ExplicitEncoderDecoderPrompt(
 
 # - Finally, here's a useful helper function for zipping encoder and
 #   decoder prompts together into a list of ExplicitEncoderDecoderPrompt
-#   instances
+#   instances. A decoder prompt of None (rather than an empty string)
+#   skips decoder tokenization and uses the default decoder start tokens.
 zipped_prompt_list = zip_enc_dec_prompts(
-    ['An encoder prompt', 'Another encoder prompt'],
-    ['A decoder prompt', 'Another decoder prompt'])
+    ['An encoder prompt', 'Another encoder prompt', 'A third encoder prompt'],
+    ['A decoder prompt', 'Another decoder prompt', None])
 
 # - Let's put all of the above example prompts together into one list
 #   which we will pass to the encoder/decoder LLM.
 prompts = [
     single_text_prompt_raw, single_text_prompt, single_tokens_prompt,
-    enc_dec_prompt1, enc_dec_prompt2, enc_dec_prompt3
-] + zipped_prompt_list
+    enc_dec_prompt1, enc_dec_prompt2, enc_dec_prompt3, *zipped_prompt_list
+]
 
 print(prompts)
 
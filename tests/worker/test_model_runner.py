@@ -8,9 +8,15 @@ from vllm.distributed.parallel_state import (ensure_model_parallel_initialized,
 from vllm.engine.arg_utils import EngineArgs
 from vllm.model_executor.sampling_metadata import SamplingMetadata
 from vllm.sequence import SamplingParams, SequenceData, SequenceGroupMetadata
-from vllm.utils import get_open_port
+from vllm.utils import get_open_port, is_pin_memory_available
 from vllm.worker.model_runner import ModelRunner, _get_graph_batch_size
 
+# One batch size per distinct path through input preparation: the three
+# branches of _get_graph_batch_size (<= 2, <= 4, multiples of 8), each with
+# and without CUDA graph padding, the wrap-around of the dummy sequence
+# lengths at block_size - 1 (15), and the largest batch previously swept.
+REPRESENTATIVE_BATCH_SIZES = [1, 2, 3, 4, 5, 8, 9, 15, 16, 17, 255, 256]
+
 
 def _create_model_runner(model: str, *args, **kwargs) -> ModelRunner:
     engine_args = EngineArgs(model, *args, **kwargs)
@@ -30,28 +36,55 @@ def _create_model_runner(model: str, *args, **kwargs) -> ModelRunner:
     return model_runner
 
 
-@pytest.mark.parametrize("batch_size", list(range(1, 257)))
-def test_prepare_prompt(batch_size):
-    model_runner = _create_model_runner(
+def _to_device(values: List[int], dtype: torch.dtype,
+               device: torch.device) -> torch.Tensor:
+    """Upload expected values without blocking on the host.
+
+    The copy is queued from pinned memory, so it overlaps with building the
+    next expected tensor; the :func:`torch.equal` that consumes it runs on
+    the same stream and therefore sees the finished copy.
+    """
+    host_tensor = torch.tensor(values,
+                               dtype=dtype,
+                               pin_memory=is_pin_memory_available())
+    return host_tensor.to(device, non_blocking=True)
+
+
+@pytest.fixture(scope="module")
+def model_runner() -> ModelRunner:
+    """Provide a model runner shared by the input preparation tests.
+
+    The engine arguments are the same for every batch size, so the engine
+    config is only created once per module.
+    """
+    return _create_model_runner(
         "facebook/opt-125m",
+        seed=0,
+        dtype="float16",
+        enforce_eager=False,
         max_num_batched_tokens=100000,
         max_num_seqs=100000,
         enable_chunked_prefill=False,
     )
 
+
+@pytest.mark.parametrize("batch_size", REPRESENTATIVE_BATCH_SIZES)
+def test_prepare_prompt(model_runner, batch_size):
     seq_lens: List[int] = []
     seq_group_metadata_list: List[SequenceGroupMetadata] = []
     block_tables = {0: [1]}
+    sampling_params = SamplingParams(temperature=0)
+    # make sure all tokens fit into one block
+    max_seq_len = model_runner.block_size - 1
     for i in range(batch_size):
-        # make sure all tokens fit into one block
-        seq_len = i % (model_runner.block_size - 1) + 1
+        seq_len = i % max_seq_len + 1
         seq_lens.append(seq_len)
         seq_data = SequenceData.from_seqs(range(seq_len))
         seq_group_metadata = SequenceGroupMetadata(
             request_id=f"test_{i}",
             is_prompt=True,
             seq_data={0: seq_data},
-            sampling_params=SamplingParams(temperature=0),
+            sampling_params=sampling_params,
             block_tables=block_tables,
         )
         assert seq_group_metadata.token_chunk_size == seq_data.get_len()
@@ -77,9 +110,8 @@ def test_prepare_prompt(batch_size):
     device = model_runner.device
     assert attn_metadata.num_prefills > 0
     assert attn_metadata.num_decode_tokens == 0
-    torch.testing.assert_close(
-        attn_metadata.seq_lens_tensor,
-        torch.tensor(seq_lens, device=device, dtype=torch.int))
+    assert torch.equal(attn_metadata.seq_lens_tensor,
+                       _to_device(seq_lens, torch.int, device))
     assert attn_metadata.seq_lens == seq_lens
     assert attn_metadata.max_prefill_seq_len == max(seq_lens)
     assert attn_metadata.max_decode_seq_len == 0
@@ -90,9 +122,8 @@ def test_prepare_prompt(batch_size):
     for seq_len in seq_lens:
         start_idx += seq_len
         start_loc.append(start_idx)
-    torch.testing.assert_close(
-        attn_metadata.query_start_loc,
-        torch.tensor(start_loc, dtype=torch.int32, device=device))
+    assert torch.equal(attn_metadata.query_start_loc,
+                       _to_device(start_loc, torch.int32, device))
 
     # Test seq start locs. Note that for normal prefill it is
     # equivalent to query_start_loc.
@@ -102,25 +133,24 @@ def test_prepare_prompt(batch_size):
         start_idx += seq_len
         seq_start_loc.append(start_idx)
 
-    torch.testing.assert_close(
-        attn_metadata.seq_start_loc,
-        torch.tensor(start_loc, dtype=torch.int32, device=device))
-    torch.testing.assert_close(
+    assert torch.equal(attn_metadata.seq_start_loc,
+                       _to_device(start_loc, torch.int32, device))
+    assert torch.equal(
         attn_metadata.context_lens_tensor,
         torch.zeros(attn_metadata.context_lens_tensor.shape[0],
                     dtype=torch.int,
                     device=device))
 
-    expected = torch.tensor([[] for _ in range(len(seq_group_metadata_list))],
-                            dtype=torch.int32,
-                            device=model_runner.device)
-    torch.testing.assert_close(attn_metadata.block_tables, expected)
+    expected = torch.empty((batch_size, 0),
+                           dtype=torch.int32,
+                           device=model_runner.device)
+    assert torch.equal(attn_metadata.block_tables, expected)
     # Cuda graph should not be used for prerill.
     assert attn_metadata.use_cuda_graph is False
 
     assert len(input_tokens) == sum(seq_lens)
     assert len(input_positions) == sum(seq_lens)
-    torch.testing.assert_close(input_tokens, input_positions)
+    assert torch.equal(input_tokens, input_positions)
 
     sampling_metadata = SamplingMetadata.prepare(
         seq_group_metadata_list,
@@ -128,40 +158,22 @@ def test_prepare_prompt(batch_size):
         query_lens=seq_lens,
         device=model_runner.device,
         pin_memory=model_runner.pin_memory)
-    assert len(input_tokens) == sum(seq_lens)
-    assert len(input_positions) == sum(seq_lens)
-    actual = sampling_metadata.selected_token_indices
-    expected = torch.tensor(expected_selected_token_indices,
-                            device=actual.device,
-                            dtype=actual.dtype)
-    torch.testing.assert_close(actual, expected)
-    torch.allclose(input_tokens, input_positions)
-
     actual = sampling_metadata.selected_token_indices
-    expected = torch.tensor(expected_selected_token_indices,
-                            device=actual.device,
-                            dtype=actual.dtype)
-    torch.testing.assert_close(actual, expected)
+    expected = _to_device(expected_selected_token_indices, actual.dtype,
+                          actual.device)
+    assert torch.equal(actual, expected)
 
 
-@pytest.mark.parametrize("batch_size", list(range(1, 257)))
-def test_prepare_decode_cuda_graph(batch_size):
-    model_runner = _create_model_runner(
-        "facebook/opt-125m",
-        seed=0,
-        dtype="float16",
-        enforce_eager=False,
-        max_num_batched_tokens=100000,
-        max_num_seqs=100000,
-        enable_chunked_prefill=False,
-    )
-
+@pytest.mark.parametrize("batch_size", REPRESENTATIVE_BATCH_SIZES)
+def test_prepare_decode_cuda_graph(model_runner, batch_size):
     context_lens: List[int] = []
     seq_group_metadata_list: List[SequenceGroupMetadata] = []
+    sampling_params = SamplingParams(temperature=0)
+    # make sure all tokens fit into one block
+    max_seq_len = model_runner.block_size - 1
     # Assume each seq group finishes prefill.
     for i in range(batch_size):
-        # make sure all tokens fit into one block
-        context_len = i % (model_runner.block_size - 1) + 1
+        context_len = i % max_seq_len + 1
         context_lens.append(context_len)
         seq_data = SequenceData.from_seqs(range(context_len))
         seq_data.update_num_computed_tokens(context_len)
@@ -171,7 +183,7 @@ def test_prepare_decode_cuda_graph(batch_size):
             request_id=f"test_{i}",
             is_prompt=False,
             seq_data={0: seq_data},
-            sampling_params=SamplingParams(temperature=0),
+            sampling_params=sampling_params,
             block_tables={0: [1]},
         )
         assert seq_group_metadata.token_chunk_size == 1
@@ -201,26 +213,22 @@ def test_prepare_decode_cuda_graph(batch_size):
         # decode has only 1 token for query.
         start_idx += 1
         start_loc.append(start_idx)
-    torch.testing.assert_close(
-        attn_metadata.query_start_loc,
-        torch.tensor(start_loc, dtype=torch.int32, device=device))
+    assert torch.equal(attn_metadata.query_start_loc,
+                       _to_device(start_loc, torch.int32, device))
 
     start_idx = 0
     seq_start_loc = [start_idx]
     for seq_len in seq_lens:
         start_idx += seq_len
         seq_start_loc.append(start_idx)
-    torch.testing.assert_close(
-        attn_metadata.seq_start_loc,
-        torch.tensor(seq_start_loc, dtype=torch.int32, device=device))
+    assert torch.equal(attn_metadata.seq_start_loc,
+                       _to_device(seq_start_loc, torch.int32, device))
 
-    torch.testing.assert_close(
-        attn_metadata.context_lens_tensor,
-        torch.tensor(context_lens, dtype=torch.int, device=device))
+    assert torch.equal(attn_metadata.context_lens_tensor,
+                       _to_device(context_lens, torch.int, device))
     assert attn_metadata.max_decode_seq_len == max(seq_lens)
-    torch.testing.assert_close(
-        attn_metadata.seq_lens_tensor[:len(seq_lens)],
-        torch.tensor(seq_lens, dtype=torch.int, device=device))
+    assert torch.equal(attn_metadata.seq_lens_tensor[:len(seq_lens)],
+                       _to_device(seq_lens, torch.int, device))
 
     # block table's first index corresponds to each batch, meaning in
     # decoding it is each token.
@@ -233,7 +241,6 @@ def test_prepare_decode_cuda_graph(batch_size):
 
     assert len(input_tokens) == expected_bs
     assert len(input_positions) == expected_bs
-    torch.allclose(input_tokens, input_positions)
 
     # Verify Sampling
     expected_selected_token_indices = []
@@ -247,32 +254,14 @@ def test_prepare_decode_cuda_graph(batch_size):
         device=model_runner.device,
         pin_memory=model_runner.pin_memory)
     actual = sampling_metadata.selected_token_indices
-    expected = torch.tensor(expected_selected_token_indices,
-                            device=actual.device,
-                            dtype=actual.dtype)
-    torch.testing.assert_close(actual, expected)
+    expected = _to_device(expected_selected_token_indices, actual.dtype,
+                          actual.device)
+    assert torch.equal(actual, expected)
 
 
-def test_empty_seq_group():
+def test_empty_seq_group(model_runner):
     """Verify prepare prompt and decode returns empty output."""
-    model_runner = _create_model_runner(
-        "facebook/opt-125m",
-        seed=0,
-        dtype="float16",
-        enforce_eager=False,
-    )
     seq_group_metadata_list: List[SequenceGroupMetadata] = []
-    model_input = model_runner._prepare_model_input_tensors(
-        seq_group_metadata_list)
-    input_tokens, input_positions, attn_metadata = (
-        model_input.input_tokens,
-        model_input.input_positions,
-        model_input.attn_metadata,
-    )
-    assert input_tokens is None
-    assert input_positions is None
-    assert attn_metadata is None
-
     model_input = model_runner._prepare_model_input_tensors(
         seq_group_metadata_list)
     (input_tokens, input_positions, attn_metadata, return_seq_lens) = (
@@ -316,18 +305,20 @@ def test_hybrid_batches(batch_size, enforce_eager, distributed_init):
     prefill_metadata_list: List[SequenceGroupMetadata] = []
     decode_metadata_list: List[SequenceGroupMetadata] = []
     block_tables = {0: [1]}
+    sampling_params = SamplingParams(temperature=0)
     prefill_batch_size = batch_size // 2
     decode_batch_size = batch_size - prefill_batch_size
+    # make sure all tokens fit into one block
+    max_seq_len = model_runner.block_size - 1
     for i in range(prefill_batch_size):
-        # make sure all tokens fit into one block
-        seq_len = i % (model_runner.block_size - 1) + 1
+        seq_len = i % max_seq_len + 1
         seq_lens.append(seq_len)
         seq_data = SequenceData.from_seqs(range(seq_len))
         seq_group_metadata = SequenceGroupMetadata(
             request_id=f"test_{i}",
             is_prompt=True,
             seq_data={0: seq_data},
-            sampling_params=SamplingParams(temperature=0),
+            sampling_params=sampling_params,
             block_tables=block_tables,
         )
         assert seq_group_metadata.token_chunk_size == seq_data.get_len()
@@ -336,8 +327,7 @@ def test_hybrid_batches(batch_size, enforce_eager, distributed_init):
 
     # Add decode requests
     for i in range(prefill_batch_size, batch_size):
-        # make sure all tokens fit into one block
-        context_len = i % (model_runner.block_size - 1) + 1
+        context_len = i % max_seq_len + 1
         seq_data = SequenceData.from_seqs(range(context_len))
         seq_data.append_token_id(1, 0)
         seq_data.update_num_computed_tokens(context_len)
@@ -345,7 +335,7 @@ def test_hybrid_batches(batch_size, enforce_eager, distributed_init):
             request_id=f"test_{i}",
             is_prompt=False,
             seq_data={0: seq_data},
-            sampling_params=SamplingParams(temperature=0),
+            sampling_params=sampling_params,
             block_tables={0: [1]},
         )
         assert seq_group_metadata.token_chunk_size == 1